@@ -51,6 +51,10 @@ function enqueueJob(jobName, payload) {
     ]);
     
     Logger.log(`Job enqueued: ${jobId} (${jobName})`);
+    
+    // Notifica o Colab (se configurado) para não esperar o próximo polling
+    wakeColabProcessor();
+    
     return jobId;
   } catch (error) {
     Logger.log('Error enqueuing job: ' + error.message);
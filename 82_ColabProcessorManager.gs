@@ -10,6 +10,9 @@
 // CONFIGURAÇÃO
 // ============================================================================
 
+/** Intervalo mínimo entre avisos /wake enviados ao Colab */
+const COLAB_WAKE_THROTTLE_SECONDS = 5;
+
 /**
  * Obtém a URL do webhook do Colab
  * Configure via PropertiesService ou retorne URL fixa
@@ -235,6 +238,47 @@ function checkColabHealth() {
   }
 }
 
+/**
+ * Avisa o processador Colab que há um novo job na fila
+ * Evita esperar o próximo ciclo de polling (que cresce quando ocioso)
+ * Webhook não configurado não é erro: retorna false sem logar
+ * Enfileiramentos em sequência (ex.: loops de teste) enviam um único aviso
+ * a cada COLAB_WAKE_THROTTLE_SECONDS, já que o processador drena a fila toda
+ * @returns {boolean} true se o aviso foi entregue
+ */
+function wakeColabProcessor() {
+  const props = PropertiesService.getScriptProperties();
+  const webhookUrl = props.getProperty('COLAB_WEBHOOK_URL');
+  
+  if (!webhookUrl) {
+    return false;
+  }
+  
+  const cache = CacheService.getScriptCache();
+  if (cache.get('COLAB_WAKE_SENT')) {
+    return true;
+  }
+  
+  try {
+    const response = UrlFetchApp.fetch(webhookUrl + '/wake', {
+      method: 'post',
+      contentType: 'application/json',
+      muteHttpExceptions: true
+    });
+    
+    if (response.getResponseCode() !== 200) {
+      return false;
+    }
+    
+    cache.put('COLAB_WAKE_SENT', '1', COLAB_WAKE_THROTTLE_SECONDS);
+    return true;
+    
+  } catch (error) {
+    Logger.log('⚠ Não foi possível acordar o Colab: ' + error.message);
+    return false;
+  }
+}
+
 // ============================================================================
 // ATIVAÇÃO AUTOMÁTICA
 // ============================================================================
@@ -3,21 +3,37 @@ Colab Automated Processor - Processador de Jobs com Ativação Remota
 Permite ativação/desativação via webhook do GAS
 
 INSTALAÇÃO:
-!pip install -q gspread pandas oauth2client flask pyngrok
+!pip install -q gspread oauth2client flask pyngrok waitress orjson
 """
 
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-import pandas as pd
+import csv
+import io
 import json
+import os
+import pickle
+import random
 import time
+from functools import partial, wraps
 from datetime import datetime, timedelta
 import traceback
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import Flask, request, jsonify
+from waitress import serve
 from pyngrok import ngrok
 import signal
+import socket
 import sys
+from requests.adapters import HTTPAdapter
+
+# orjson é opcional: serializa bem mais rápido, mas o módulo json padrão basta
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ============================================================================
 # CONFIGURAÇÃO
@@ -26,6 +42,26 @@ import sys
 SPREADSHEET_ID = None
 JOB_QUEUE_SHEET_NAME = 'JobQueue'
 
+# Aba auxiliar calculada pelo Sheets: A1 lista as primeiras PENDING_INDEX_LIMIT
+# linhas PENDING e A2:B6 traz a contagem de jobs por status (COUNTIF)
+JOB_INDEX_SHEET_NAME = 'JobQueueIndex'
+JOB_STATS_RANGE = 'A2:B6'
+
+# Limite de linhas por recarga do espelho: mantém a célula do índice bem abaixo
+# do limite do TEXTJOIN e a URL do batchGet curta, mesmo com fila grande
+PENDING_INDEX_LIMIT = 20
+
+# Sem pendentes a célula fica vazia; qualquer outro erro aparece como "#..."
+PENDING_ROWS_FORMULA = (
+    f'=IF(COUNTIF({JOB_QUEUE_SHEET_NAME}!C2:C, "PENDING") = 0, "", '
+    f'TEXTJOIN(",", TRUE, ARRAY_CONSTRAIN(FILTER(ROW({JOB_QUEUE_SHEET_NAME}!C2:C), '
+    f'{JOB_QUEUE_SHEET_NAME}!C2:C = "PENDING"), {PENDING_INDEX_LIMIT}, 1)))'
+)
+JOB_STATS_STATUSES = ('PENDING', 'CLAIMED', 'RUNNING', 'COMPLETED', 'FAILED')
+
+# Credenciais reaproveitadas entre execuções do notebook
+TOKEN_CACHE_PATH = '/content/.gspread_token.pickle'
+
 SCOPE = [
     'https://spreadsheets.google.com/feeds',
     'https://www.googleapis.com/auth/drive'
@@ -33,16 +69,57 @@ SCOPE = [
 
 # Estado global
 _processor_state = {
-    'gc': None,
+    'creds': None,
     'spreadsheet': None,
-    'job_queue_sheet': None,
     'is_running': False,
     'spreadsheet_id': None,
     'processor_thread': None,
     'webhook_url': None,
-    'auto_stop_timer': None
+    'auto_stop_timer': None,
+    'stop_event': threading.Event(),
+    'wake_event': threading.Event(),
+    'queue_mirror': deque(),
+    'pending_writes': [],
+    'writes_lock': threading.Lock(),
+    'flush_lock': threading.Lock(),
+    'flush_event': threading.Event(),
+    'flush_thread': None,
+    'executor': None,
+    'worker_slots': None
 }
 
+# Linhas lidas por requisição no EXPORT_CSV (limita o pico de memória)
+EXPORT_CHUNK_ROWS = 10000
+
+# Número de jobs processados em paralelo (handlers são limitados por I/O)
+MAX_WORKERS = 4
+
+# Retentativas para erros transitórios da API do Sheets (quota / 5xx)
+RETRY_ATTEMPTS = 6
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503)
+
+# Jobs CLAIMED/RUNNING há mais tempo que isso voltam para PENDING na partida
+STALE_CLAIM_MINUTES = 30
+
+# Intervalo máximo entre verificações quando a fila está ociosa (segundos)
+MAX_POLL_INTERVAL = 60
+
+# Auto-stop após o equivalente a 10 verificações ociosas (10 * interval segundos)
+AUTO_STOP_IDLE_CHECKS = 10
+
+# Gravações de status acumuladas são enviadas a cada FLUSH_INTERVAL segundos
+# ou assim que houver FLUSH_BATCH_SIZE células pendentes
+FLUSH_INTERVAL = 2
+FLUSH_BATCH_SIZE = 10
+
+# Protege _processor_state entre endpoints (waitress), processador e sinais.
+# Events e locks são criados uma única vez e nunca substituídos, por isso
+# suas referências são lidas sem o lock (pending_writes usa writes_lock).
+_state_lock = threading.RLock()
+
+# Cliente gspread por thread: a sessão HTTP não é documentada como thread-safe
+_thread_local = threading.local()
+
 # Flask app para webhook
 app = Flask(__name__)
 
@@ -50,22 +127,71 @@ app = Flask(__name__)
 # AUTENTICAÇÃO
 # ============================================================================
 
+def _load_cached_credentials():
+    """Carrega as credenciais salvas, renovando o token se expirado"""
+    try:
+        with open(TOKEN_CACHE_PATH, 'rb') as f:
+            creds = pickle.load(f)
+        
+        if not creds.valid:
+            from google.auth.transport.requests import Request
+            creds.refresh(Request())
+            _save_cached_credentials(creds)
+        
+        return creds
+    except Exception:
+        return None
+
+def _save_cached_credentials(creds):
+    """Salva as credenciais para as próximas execuções (somente o dono lê)"""
+    try:
+        # Cria o arquivo já com permissão 0600 (sem janela com a umask padrão)
+        fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # caso o arquivo já existisse com outra permissão
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(creds, f)
+    except Exception as e:
+        print(f"⚠ Não foi possível salvar as credenciais: {e}")
+
 def authenticate_gspread():
     """Autentica e retorna o cliente gspread"""
     try:
-        from google.colab import auth
-        auth.authenticate_user()
+        creds = _load_cached_credentials()
+        
+        if creds is None:
+            from google.colab import auth
+            auth.authenticate_user()
+            
+            from google.auth import default
+            creds, _ = default()
+            _save_cached_credentials(creds)
         
-        import gspread
-        from google.auth import default
-        creds, _ = default()
+        with _state_lock:
+            _processor_state['creds'] = creds
         
-        gc = gspread.authorize(creds)
-        return gc
+        return _authorize(creds)
     except Exception as e:
         print(f"✗ Erro na autenticação: {e}")
         raise
 
+def _authorize(creds):
+    """Cria um cliente gspread com o pool de conexões configurado"""
+    gc = gspread.authorize(creds)
+    _configure_http_session(gc)
+    return gc
+
+def _configure_http_session(gc):
+    """Reaproveita conexões TCP/TLS em todas as chamadas à API do Sheets"""
+    # gspread >= 6 expõe a sessão em gc.http_client; versões anteriores em gc
+    http_client = getattr(gc, 'http_client', gc)
+    session = http_client.session
+    
+    # Mantém a sessão autenticada e apenas troca o pool de conexões
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount('https://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
 # ============================================================================
 # SETUP
 # ============================================================================
@@ -107,11 +233,26 @@ def setup_processor(spreadsheet_id):
             job_queue_sheet.append_row(headers)
             print(f"✓ Aba '{JOB_QUEUE_SHEET_NAME}' criada com sucesso")
         
-        SPREADSHEET_ID = spreadsheet_id
-        _processor_state['gc'] = gc
-        _processor_state['spreadsheet'] = spreadsheet
-        _processor_state['job_queue_sheet'] = job_queue_sheet
-        _processor_state['spreadsheet_id'] = spreadsheet_id
+        print(f"\n4. Preparando índice de pendentes '{JOB_INDEX_SHEET_NAME}'...")
+        _ensure_index_sheet(spreadsheet)
+        print(f"✓ Índice pronto: {JOB_INDEX_SHEET_NAME}!A1")
+        
+        with _state_lock:
+            SPREADSHEET_ID = spreadsheet_id
+            _processor_state['spreadsheet'] = spreadsheet
+            _processor_state['spreadsheet_id'] = spreadsheet_id
+            _processor_state['queue_mirror'].clear()
+            
+            if _processor_state['executor'] is None:
+                _processor_state['executor'] = ThreadPoolExecutor(
+                    max_workers=MAX_WORKERS,
+                    thread_name_prefix='job-worker'
+                )
+                _processor_state['worker_slots'] = threading.BoundedSemaphore(MAX_WORKERS)
+        
+        # A thread do setup reaproveita os objetos que acabou de criar
+        _thread_local.spreadsheet_id = spreadsheet_id
+        _thread_local.ctx = ProcessorCtx(gc, spreadsheet, job_queue_sheet)
         
         print("\n" + "=" * 60)
         print("✓ PROCESSADOR CONFIGURADO COM SUCESSO")
@@ -126,17 +267,103 @@ def setup_processor(spreadsheet_id):
         traceback.print_exc()
         return False
 
-def _ensure_initialized():
-    """Garante que o processador foi inicializado"""
-    if _processor_state['spreadsheet'] is None:
-        raise RuntimeError(
-            "Processador não configurado! Execute setup_processor(spreadsheet_id) primeiro."
+def _ensure_index_sheet(spreadsheet):
+    """Cria (se preciso) a aba de índice e grava as fórmulas de pendentes e contagens"""
+    try:
+        index_sheet = spreadsheet.worksheet(JOB_INDEX_SHEET_NAME)
+    except gspread.exceptions.WorksheetNotFound:
+        index_sheet = spreadsheet.add_worksheet(
+            title=JOB_INDEX_SHEET_NAME,
+            rows=10,
+            cols=2
         )
-    return (
-        _processor_state['gc'],
-        _processor_state['spreadsheet'],
-        _processor_state['job_queue_sheet']
-    )
+    
+    stats_rows = [
+        [status, f'=COUNTIF({JOB_QUEUE_SHEET_NAME}!C2:C, "{status}")']
+        for status in JOB_STATS_STATUSES
+    ]
+    
+    # USER_ENTERED para que as fórmulas sejam interpretadas
+    index_sheet.batch_update([
+        {'range': 'A1', 'values': [[PENDING_ROWS_FORMULA]]},
+        {'range': JOB_STATS_RANGE, 'values': stats_rows}
+    ], value_input_option='USER_ENTERED')
+    return index_sheet
+
+class ProcessorCtx:
+    """Clientes gspread de uma thread (acesso por atributo, sem desempacotar tuplas)"""
+    __slots__ = ('gc', 'spreadsheet', 'sheet')
+    
+    def __init__(self, gc, spreadsheet, sheet):
+        self.gc = gc
+        self.spreadsheet = spreadsheet
+        self.sheet = sheet
+
+def _require_configured():
+    """Garante que o processador foi configurado; retorna (spreadsheet_id, creds)"""
+    with _state_lock:
+        if _processor_state['spreadsheet'] is None:
+            raise RuntimeError(
+                "Processador não configurado! Execute setup_processor(spreadsheet_id) primeiro."
+            )
+        return _processor_state['spreadsheet_id'], _processor_state['creds']
+
+def _ensure_initialized():
+    """Garante que o processador foi inicializado e retorna o contexto desta thread"""
+    spreadsheet_id, creds = _require_configured()
+    
+    # Cada thread abre seu próprio cliente na primeira chamada (ou após novo setup)
+    if getattr(_thread_local, 'spreadsheet_id', None) != spreadsheet_id:
+        gc = _authorize(creds)
+        spreadsheet = gc.open_by_key(spreadsheet_id)
+        job_queue_sheet = spreadsheet.worksheet(JOB_QUEUE_SHEET_NAME)
+        
+        _thread_local.spreadsheet_id = spreadsheet_id
+        _thread_local.ctx = ProcessorCtx(gc, spreadsheet, job_queue_sheet)
+    
+    return _thread_local.ctx
+
+# ============================================================================
+# SERIALIZAÇÃO
+# ============================================================================
+
+def _json_loads(text):
+    """Desserializa JSON (orjson quando disponível)"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def _dump_capped(obj, cap=500):
+    """Serializa para JSON limitando o tamanho a cap caracteres"""
+    if orjson is not None:
+        text = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    else:
+        text = json.dumps(obj)
+    
+    if len(text) > cap:
+        text = text[:cap - 3] + '...'
+    return text
+
+# ============================================================================
+# RETENTATIVAS
+# ============================================================================
+
+def retry_gspread(fn):
+    """Repete a chamada com backoff exponencial em erros 429/5xx do Sheets"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                return fn(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status_code = getattr(e.response, 'status_code', None)
+                if status_code not in RETRYABLE_STATUS_CODES or attempt == RETRY_ATTEMPTS - 1:
+                    raise
+                
+                delay = 2 ** attempt + random.random()
+                print(f"⚠ API do Sheets respondeu {status_code}, nova tentativa em {delay:.1f}s")
+                time.sleep(delay)
+    return wrapper
 
 # ============================================================================
 # STATUS DE JOBS
@@ -153,67 +380,141 @@ class JobStatus:
 # PROCESSAMENTO DE JOBS
 # ============================================================================
 
+@retry_gspread
+def _values_get(spreadsheet, range_name, value_render_option=None, date_time_render_option=None):
+    """Lê apenas o intervalo pedido (values.get) e retorna a lista de linhas"""
+    params = {'majorDimension': 'ROWS'}
+    if value_render_option:
+        params['valueRenderOption'] = value_render_option
+    if date_time_render_option:
+        params['dateTimeRenderOption'] = date_time_render_option
+    
+    response = spreadsheet.values_get(range_name, params=params)
+    return response.get('values', [])
+
+@retry_gspread
+def _values_batch_get(spreadsheet, ranges):
+    """Lê vários intervalos numa única requisição (values.batchGet)"""
+    response = spreadsheet.values_batch_get(ranges)
+    return [value_range.get('values', []) for value_range in response.get('valueRanges', [])]
+
+def _load_pending_jobs(ctx):
+    """Lê da planilha os jobs PENDING (no máximo PENDING_INDEX_LIMIT)"""
+    spreadsheet = ctx.spreadsheet
+    jobs = []
+    
+    # Grava as transições acumuladas antes, para não reler jobs já reivindicados
+    _flush_pending_writes()
+    
+    # Uma única célula com as linhas PENDING, ex.: "2,7,15"
+    index_value = _values_get(spreadsheet, f"{JOB_INDEX_SHEET_NAME}!A1")
+    index_value = str(index_value[0][0]) if index_value and index_value[0] else ''
+    if index_value.startswith('#'):
+        raise RuntimeError(f"Erro na fórmula de {JOB_INDEX_SHEET_NAME}!A1: {index_value}")
+    
+    pending_rows = [int(i) for i in index_value.split(',') if i.strip()]
+    
+    if not pending_rows:
+        return jobs
+    
+    # Carrega apenas as linhas pendentes (A:F), numa só leitura (no máximo PENDING_INDEX_LIMIT)
+    rows = _values_batch_get(
+        spreadsheet,
+        [f"{JOB_QUEUE_SHEET_NAME}!A{i}:F{i}" for i in pending_rows]
+    )
+    
+    for i, row in zip(pending_rows, rows):
+        try:
+            row = (row[0] if row else []) + [''] * 6
+            
+            # O índice pode estar defasado (ex.: linhas removidas pela limpeza)
+            if row[2] != JobStatus.PENDING:
+                continue
+            
+            jobs.append({
+                'row': i,
+                'jobId': row[0],
+                'jobName': row[1],
+                'status': JobStatus.PENDING,
+                'payload': _json_loads(row[3]) if row[3] else {},
+                'timestamp_enqueued': row[4],
+                'user_email': row[5]
+            })
+            
+        except Exception as e:
+            # Marca como FAILED para não ocupar o índice (limitado) para sempre
+            print(f"✗ Erro ao carregar job na linha {i}: {e}")
+            _queue_writes(row[0], i, {
+                'C': JobStatus.FAILED,
+                'H': datetime.now().isoformat(),
+                'J': type(e).__name__,
+                'K': str(e)[:500]
+            })
+            continue
+    
+    return jobs
+
 def claim_next_job():
     """Reivindica o próximo job PENDING"""
     try:
-        gc, spreadsheet, job_queue_sheet = _ensure_initialized()
+        ctx = _ensure_initialized()
         
-        all_values = job_queue_sheet.get_all_values()
+        with _state_lock:
+            queue_mirror = _processor_state['queue_mirror']
+            job = queue_mirror.popleft() if queue_mirror else None
         
-        if len(all_values) <= 1:
+        # Espelho vazio: recarrega da planilha (fora do lock, pois faz chamadas à API)
+        if job is None:
+            jobs = _load_pending_jobs(ctx)
+            
+            with _state_lock:
+                queue_mirror.extend(jobs)
+                job = queue_mirror.popleft() if queue_mirror else None
+        
+        if job is None:
             return None
         
-        for i, row in enumerate(all_values[1:], start=2):
-            if len(row) >= 3 and row[2] == JobStatus.PENDING:
-                try:
-                    timestamp_claimed = datetime.now().isoformat()
-                    job_queue_sheet.update_cell(i, 3, JobStatus.CLAIMED)
-                    job_queue_sheet.update_cell(i, 7, timestamp_claimed)
-                    
-                    job = {
-                        'row': i,
-                        'jobId': row[0],
-                        'jobName': row[1],
-                        'status': JobStatus.CLAIMED,
-                        'payload': json.loads(row[3]) if row[3] else {},
-                        'timestamp_enqueued': row[4],
-                        'user_email': row[5],
-                        'timestamp_claimed': timestamp_claimed
-                    }
-                    
-                    print(f"✓ Job reivindicado: {job['jobId']} ({job['jobName']})")
-                    return job
-                    
-                except Exception as e:
-                    print(f"✗ Erro ao reivindicar job na linha {i}: {e}")
-                    continue
+        timestamp_claimed = datetime.now().isoformat()
+        row = job['row']
         
-        return None
+        _queue_writes(job['jobId'], row, {
+            'C': JobStatus.CLAIMED,
+            'G': timestamp_claimed
+        })
+        
+        job['status'] = JobStatus.CLAIMED
+        job['timestamp_claimed'] = timestamp_claimed
+        
+        print(f"✓ Job reivindicado: {job['jobId']} ({job['jobName']})")
+        return job
         
     except Exception as e:
         print(f"✗ Erro ao buscar jobs: {e}")
         return None
 
-def update_job_status(row, status, result=None, error_code=None, error_message=None):
-    """Atualiza o status de um job"""
+def update_job_status(row, status, result=None, error_code=None, error_message=None, job_id=None):
+    """Atualiza o status de um job (job_id confirma a linha antes de gravar)"""
     try:
-        gc, spreadsheet, job_queue_sheet = _ensure_initialized()
+        # Só confere a configuração: a gravação acontece na thread de sincronização
+        _require_configured()
         
         timestamp_completed = datetime.now().isoformat()
         
-        job_queue_sheet.update_cell(row, 3, status)
-        job_queue_sheet.update_cell(row, 8, timestamp_completed)
+        # Uma única requisição por transição de estado
+        cells = {
+            'C': status,
+            'H': timestamp_completed
+        }
         
         if result is not None:
-            result_str = json.dumps(result)
-            if len(result_str) > 500:
-                result_str = result_str[:497] + '...'
-            job_queue_sheet.update_cell(row, 9, result_str)
+            cells['I'] = _dump_capped(result)
         
         if error_code:
-            job_queue_sheet.update_cell(row, 10, error_code)
+            cells['J'] = error_code
         if error_message:
-            job_queue_sheet.update_cell(row, 11, error_message[:500])
+            cells['K'] = error_message[:500]
+        
+        _queue_writes(job_id, row, cells)
         
         print(f"✓ Status atualizado para {status} na linha {row}")
         
@@ -221,28 +522,155 @@ def update_job_status(row, status, result=None, error_code=None, error_message=N
         print(f"✗ Erro ao atualizar status: {e}")
         raise
 
+# ============================================================================
+# SINCRONIZAÇÃO COM A PLANILHA
+# ============================================================================
+
+def _merge_writes(target, writes):
+    """Mescla writes em target por (jobId, linha); células mais novas prevalecem"""
+    by_key = {(w['jobId'], w['row']): w for w in target}
+    for w in writes:
+        entry = by_key.get((w['jobId'], w['row']))
+        if entry is None:
+            entry = {'jobId': w['jobId'], 'row': w['row'], 'cells': {}}
+            by_key[(w['jobId'], w['row'])] = entry
+            target.append(entry)
+        entry['cells'].update(w['cells'])
+
+def _queue_writes(job_id, row, cells):
+    """Acumula as células {coluna: valor} de uma linha para o próximo batch_update"""
+    with _processor_state['writes_lock']:
+        pending_writes = _processor_state['pending_writes']
+        _merge_writes(pending_writes, [{'jobId': job_id, 'row': row, 'cells': cells}])
+        pending_cells = sum(len(w['cells']) for w in pending_writes)
+    
+    if pending_cells >= FLUSH_BATCH_SIZE:
+        _processor_state['flush_event'].set()
+
+def _resolve_write_rows(spreadsheet, writes):
+    """Confere o jobId (coluna A) de cada linha e corrige linhas deslocadas"""
+    # cleanupOldJobs (GAS) apaga linhas, deslocando as seguintes para cima
+    rows = sorted({w['row'] for w in writes if w['jobId']})
+    if not rows:
+        return
+    
+    found = _values_batch_get(spreadsheet, [f"{JOB_QUEUE_SHEET_NAME}!A{r}" for r in rows])
+    job_id_at = {r: (v[0][0] if v and v[0] else '') for r, v in zip(rows, found)}
+    
+    moved = [w for w in writes if w['jobId'] and job_id_at.get(w['row']) != w['jobId']]
+    if not moved:
+        return
+    
+    # Alguma linha mudou: localiza os jobs pelo jobId
+    job_ids = _values_get(spreadsheet, f"{JOB_QUEUE_SHEET_NAME}!A2:A")
+    row_by_id = {r[0]: i for i, r in enumerate(job_ids, start=2) if r}
+    
+    for w in moved:
+        w['row'] = row_by_id.get(w['jobId'])
+        if w['row'] is None:
+            print(f"⚠ Job {w['jobId']} não está mais na fila; status descartado")
+
+@retry_gspread
+def _batch_update(sheet, updates):
+    """batch_update com retentativas"""
+    sheet.batch_update(updates, value_input_option='RAW')
+
+def _flush_pending_writes():
+    """Envia todas as gravações acumuladas em um único batch_update"""
+    # flush_lock garante que quem lê a planilha depois do flush veja tudo gravado
+    with _processor_state['flush_lock']:
+        with _processor_state['writes_lock']:
+            writes = _processor_state['pending_writes']
+            _processor_state['pending_writes'] = []
+        
+        if not writes:
+            return
+        
+        try:
+            ctx = _ensure_initialized()
+            _resolve_write_rows(ctx.spreadsheet, writes)
+            
+            # Após corrigir as linhas, jobs diferentes não compartilham linha,
+            # mas o mesmo job pode aparecer sob linhas antigas e novas
+            cells_by_row = {}
+            for w in writes:
+                if w['row'] is not None:
+                    cells_by_row.setdefault(w['row'], {}).update(w['cells'])
+            
+            updates = [
+                {'range': f"{column}{row}", 'values': [[value]]}
+                for row, cells in cells_by_row.items()
+                for column, value in cells.items()
+            ]
+            if updates:
+                _batch_update(ctx.sheet, updates)
+        except Exception:
+            # Devolve à fila (na frente) para a próxima tentativa; o que foi
+            # enfileirado durante o flush é mais novo e prevalece
+            with _processor_state['writes_lock']:
+                _merge_writes(writes, _processor_state['pending_writes'])
+                _processor_state['pending_writes'] = writes
+            raise
+
+def _flush_loop():
+    """Sincroniza periodicamente as transições de status (executa em thread)"""
+    flush_event = _processor_state['flush_event']
+    stop_event = _processor_state['stop_event']
+    
+    while not stop_event.is_set():
+        flush_event.wait(FLUSH_INTERVAL)
+        flush_event.clear()
+        
+        try:
+            _flush_pending_writes()
+        except Exception as e:
+            print(f"✗ Erro ao sincronizar status: {e}")
+
+def recover_stale_jobs(max_age_minutes=STALE_CLAIM_MINUTES):
+    """Devolve para PENDING jobs CLAIMED/RUNNING abandonados (ex.: queda do Colab)"""
+    ctx = _ensure_initialized()
+    
+    # Colunas C (status) a G (timestamp_claimed)
+    rows = _values_get(ctx.spreadsheet, f"{JOB_QUEUE_SHEET_NAME}!C2:G")
+    cutoff = datetime.now() - timedelta(minutes=max_age_minutes)
+    
+    updates = []
+    for i, row in enumerate(rows, start=2):
+        if len(row) < 5 or row[0] not in (JobStatus.CLAIMED, JobStatus.RUNNING):
+            continue
+        
+        try:
+            timestamp_claimed = datetime.fromisoformat(row[4])
+        except ValueError:
+            continue
+        
+        if timestamp_claimed < cutoff:
+            updates.append({'range': f'C{i}', 'values': [[JobStatus.PENDING]]})
+            updates.append({'range': f'G{i}', 'values': [['']]})
+    
+    if updates:
+        _batch_update(ctx.sheet, updates)
+        print(f"♻️  {len(updates) // 2} job(s) abandonado(s) devolvido(s) para PENDING")
+    
+    return len(updates) // 2
+
 def process_job(job):
     """Processa um job reivindicado"""
     try:
-        update_job_status(job['row'], JobStatus.RUNNING)
+        update_job_status(job['row'], JobStatus.RUNNING, job_id=job['jobId'])
         
         job_name = job['jobName']
         payload = job['payload']
         
         print(f"▶ Processando job: {job_name}")
         
-        if job_name == 'EXPORT_CSV':
-            result = handle_export_csv(payload)
-        elif job_name == 'BATCH_CLEANUP':
-            result = handle_batch_cleanup(payload)
-        elif job_name == 'GENERATE_REPORT':
-            result = handle_generate_report(payload)
-        elif job_name == 'CALCULATE_STATS':
-            result = handle_stats_calculation(payload)
-        else:
+        handler = JOB_HANDLERS.get(job_name)
+        if handler is None:
             raise ValueError(f"Job desconhecido: {job_name}")
         
-        update_job_status(job['row'], JobStatus.COMPLETED, result=result)
+        result = handler(payload)
+        
+        update_job_status(job['row'], JobStatus.COMPLETED, result=result, job_id=job['jobId'])
         print(f"✓ Job concluído: {job['jobId']}")
         
     except Exception as e:
@@ -253,7 +681,8 @@ def process_job(job):
             job['row'],
             JobStatus.FAILED,
             error_code=error_code,
-            error_message=error_message
+            error_message=error_message,
+            job_id=job['jobId']
         )
 
 # ============================================================================
@@ -262,21 +691,51 @@ def process_job(job):
 
 def handle_export_csv(payload):
     """Exporta uma planilha para CSV"""
-    gc, spreadsheet, job_queue_sheet = _ensure_initialized()
+    ctx = _ensure_initialized()
     
     sheet_name = payload.get('sheetName')
     if not sheet_name:
         raise ValueError("sheetName é obrigatório no payload")
     
-    sheet = spreadsheet.worksheet(sheet_name)
-    data = sheet.get_all_values()
+    sheet = ctx.spreadsheet.worksheet(sheet_name)
+    
+    # Aspas simples no nome da aba são escapadas duplicando-as (notação A1)
+    quoted_name = "'{}'".format(sheet_name.replace("'", "''"))
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    written_rows = 0
+    blank_rows = 0
+    width = None
+    
+    # Lê em blocos de linhas e escreve cada bloco direto no csv.writer
+    for start in range(1, sheet.row_count + 1, EXPORT_CHUNK_ROWS):
+        end = min(start + EXPORT_CHUNK_ROWS - 1, sheet.row_count)
+        chunk = _values_get(
+            ctx.spreadsheet,
+            f"{quoted_name}!{start}:{end}",
+            value_render_option='UNFORMATTED_VALUE',
+            date_time_render_option='FORMATTED_STRING'
+        )
+        
+        # A API omite linhas vazias no fim do bloco; só as repõe se houver dados depois
+        if chunk:
+            # A API também corta células vazias no fim da linha: completa até a largura do cabeçalho
+            if width is None:
+                width = len(chunk[0]) if blank_rows == 0 else 0
+            
+            writer.writerows([[''] * width] * blank_rows)
+            writer.writerows(row + [''] * (width - len(row)) for row in chunk)
+            written_rows += blank_rows + len(chunk)
+            blank_rows = 0
+        
+        blank_rows += (end - start + 1) - len(chunk)
     
-    df = pd.DataFrame(data[1:], columns=data[0])
-    csv_content = df.to_csv(index=False, encoding='utf-8')
+    csv_content = buffer.getvalue()
     
     return {
         'message': 'CSV gerado com sucesso',
-        'rows': len(df),
+        'rows': max(written_rows - 1, 0),
         'sheet': sheet_name
     }
 
@@ -306,22 +765,60 @@ def handle_generate_report(payload):
         'format': 'PDF'
     }
 
+# Registro de handlers: jobName -> função(payload)
+JOB_HANDLERS = {
+    'EXPORT_CSV': handle_export_csv,
+    'BATCH_CLEANUP': handle_batch_cleanup,
+    'GENERATE_REPORT': handle_generate_report,
+    'CALCULATE_STATS': handle_stats_calculation
+}
+
 # ============================================================================
 # LOOP DE PROCESSAMENTO
 # ============================================================================
 
+def _acquire_worker_slot(worker_slots, stop_event):
+    """Aguarda um worker livre; retorna False se o processador for parado"""
+    while not worker_slots.acquire(timeout=1):
+        if stop_event.is_set():
+            return False
+    
+    return True
+
+def _on_job_done(worker_slots, future):
+    """Libera o worker ao final de um job"""
+    worker_slots.release()
+    
+    error = future.exception()
+    if error:
+        print(f"✗ Erro inesperado no worker: {error}")
+
 def _processor_loop(interval=5, max_iterations=None, auto_stop_minutes=None):
     """Loop principal de processamento (executa em thread)"""
     iteration = 0
     idle_count = 0
+    idle_since = None
     start_time = time.time()
+    wake_event = _processor_state['wake_event']
+    stop_event = _processor_state['stop_event']
+    in_flight = set()
+    
+    with _state_lock:
+        executor = _processor_state['executor']
+        worker_slots = _processor_state['worker_slots']
     
     print(f"\n🚀 Processador iniciado (intervalo: {interval}s)")
     if auto_stop_minutes:
         print(f"⏱️  Auto-stop em {auto_stop_minutes} minutos")
     
     try:
-        while _processor_state['is_running']:
+        # Falha na recuperação não impede o processador de iniciar
+        try:
+            recover_stale_jobs()
+        except Exception as e:
+            print(f"⚠ Não foi possível recuperar jobs abandonados: {e}")
+        
+        while not stop_event.is_set():
             iteration += 1
             
             # Verifica limite de iterações
@@ -336,51 +833,102 @@ def _processor_loop(interval=5, max_iterations=None, auto_stop_minutes=None):
                     print(f"\n⏱️  Auto-stop: {auto_stop_minutes} minutos decorridos")
                     break
             
+            # Só reivindica quando há worker livre para o job
+            if not _acquire_worker_slot(worker_slots, stop_event):
+                break
+            
             print(f"\n[Iteração {iteration}] Verificando jobs...")
+            wake_event.clear()
+            
+            # Um stop entre o teste do while e o clear acima teria o wake apagado
+            if stop_event.is_set():
+                worker_slots.release()
+                break
+            
             job = claim_next_job()
             
             if job:
-                process_job(job)
+                future = executor.submit(process_job, job)
+                in_flight.add(future)
+                future.add_done_callback(in_flight.discard)
+                future.add_done_callback(partial(_on_job_done, worker_slots))
                 idle_count = 0
-            else:
-                print("⏳ Nenhum job pendente")
-                idle_count += 1
+                idle_since = None
                 
-                # Auto-stop após 10 verificações sem jobs
-                if auto_stop_minutes and idle_count >= 10:
-                    print(f"\n⏹️  Auto-stop: Sem jobs por {idle_count} verificações")
-                    break
+                # Há job na fila: tenta o próximo sem esperar
+                continue
+            
+            worker_slots.release()
+            print("⏳ Nenhum job pendente")
+            idle_count += 1
+            if idle_since is None:
+                idle_since = time.time()
+            
+            # Auto-stop pelo tempo ocioso (e não pelo número de verificações,
+            # que com o backoff passaria a representar vários minutos)
+            idle_seconds = time.time() - idle_since
+            if auto_stop_minutes and idle_seconds >= AUTO_STOP_IDLE_CHECKS * interval:
+                print(f"\n⏹️  Auto-stop: Sem jobs por {idle_seconds:.0f}s ({idle_count} verificações)")
+                break
             
-            time.sleep(interval)
+            # Backoff exponencial enquanto ocioso (interval, 2x, 4x...);
+            # /wake e stop interrompem a espera
+            delay = min(interval * (2 ** (idle_count - 1)), MAX_POLL_INTERVAL)
+            if stop_event.is_set():
+                break
+            if wake_event.wait(delay):
+                if stop_event.is_set():
+                    break
+                print("🔔 Wake recebido")
     
     except Exception as e:
         print(f"\n✗ Erro no processador: {e}")
         traceback.print_exc()
     
     finally:
-        _processor_state['is_running'] = False
+        stop_event.set()
+        
+        # Aguarda os jobs em andamento antes da sincronização final
+        wait(in_flight.copy())
+        _processor_state['flush_event'].set()
+        
+        try:
+            _flush_pending_writes()
+        except Exception as e:
+            print(f"✗ Erro ao sincronizar status: {e}")
+        
+        with _state_lock:
+            _processor_state['is_running'] = False
         print("\n⏹️  Processador parado")
 
 def start_processor_background(interval=5, max_iterations=None, auto_stop_minutes=30):
     """Inicia o processador em background"""
     global _processor_state
     
-    if _processor_state['is_running']:
-        return {'success': False, 'message': 'Processador já está rodando'}
-    
-    if _processor_state['spreadsheet'] is None:
-        return {'success': False, 'message': 'Processador não configurado'}
-    
-    _processor_state['is_running'] = True
-    
-    thread = threading.Thread(
-        target=_processor_loop,
-        args=(interval, max_iterations, auto_stop_minutes),
-        daemon=True
-    )
-    thread.start()
-    
-    _processor_state['processor_thread'] = thread
+    # Verificação e início atômicos: duas chamadas a /activate não criam dois loops
+    with _state_lock:
+        if _processor_state['is_running']:
+            return {'success': False, 'message': 'Processador já está rodando'}
+        
+        if _processor_state['spreadsheet'] is None:
+            return {'success': False, 'message': 'Processador não configurado'}
+        
+        _processor_state['is_running'] = True
+        _processor_state['stop_event'].clear()
+        _processor_state['queue_mirror'].clear()
+        
+        thread = threading.Thread(
+            target=_processor_loop,
+            args=(interval, max_iterations, auto_stop_minutes),
+            daemon=True
+        )
+        thread.start()
+        
+        flush_thread = threading.Thread(target=_flush_loop, daemon=True)
+        flush_thread.start()
+        
+        _processor_state['processor_thread'] = thread
+        _processor_state['flush_thread'] = flush_thread
     
     return {
         'success': True,
@@ -392,15 +940,20 @@ def stop_processor():
     """Para o processador"""
     global _processor_state
     
-    if not _processor_state['is_running']:
-        return {'success': False, 'message': 'Processador não está rodando'}
+    with _state_lock:
+        if not _processor_state['is_running']:
+            return {'success': False, 'message': 'Processador não está rodando'}
+        
+        # stop_event encerra o loop; wake_event interrompe a espera em andamento
+        _processor_state['stop_event'].set()
+        _processor_state['wake_event'].set()
+        processor_thread = _processor_state['processor_thread']
     
-    _processor_state['is_running'] = False
     print("\n⏹️  Sinal de parada enviado...")
     
-    # Aguarda thread finalizar (máximo 10s)
-    if _processor_state['processor_thread']:
-        _processor_state['processor_thread'].join(timeout=10)
+    # Aguarda thread finalizar (máximo 10s), fora do lock para o loop poder encerrar
+    if processor_thread:
+        processor_thread.join(timeout=10)
     
     return {'success': True, 'message': 'Processador parado'}
 
@@ -411,10 +964,14 @@ def stop_processor():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Verifica se o servidor está ativo"""
+    with _state_lock:
+        processor_running = _processor_state['is_running']
+        spreadsheet_id = _processor_state['spreadsheet_id']
+    
     return jsonify({
         'status': 'online',
-        'processor_running': _processor_state['is_running'],
-        'spreadsheet_id': _processor_state['spreadsheet_id'],
+        'processor_running': processor_running,
+        'spreadsheet_id': spreadsheet_id,
         'timestamp': datetime.now().isoformat()
     })
 
@@ -457,34 +1014,57 @@ def deactivate_processor():
             'error': str(e)
         }), 500
 
+@app.route('/wake', methods=['POST'])
+def wake_processor():
+    """Acorda o processador para verificar a fila imediatamente"""
+    with _state_lock:
+        _processor_state['wake_event'].set()
+        processor_running = _processor_state['is_running']
+    
+    return jsonify({
+        'success': True,
+        'processor_running': processor_running
+    })
+
 @app.route('/status', methods=['GET'])
 def get_status():
     """Retorna status detalhado do processador"""
     try:
-        gc, spreadsheet, job_queue_sheet = _ensure_initialized()
-        
-        # Conta jobs por status
-        all_values = job_queue_sheet.get_all_values()
-        stats = {
-            'PENDING': 0,
-            'CLAIMED': 0,
-            'RUNNING': 0,
-            'COMPLETED': 0,
-            'FAILED': 0
-        }
+        ctx = _ensure_initialized()
+        
+        # Contagens calculadas pelo Sheets (COUNTIF): lê só 5 linhas
+        stats = {status: 0 for status in JOB_STATS_STATUSES}
+        stats_rows = _values_get(
+            ctx.spreadsheet,
+            f"{JOB_INDEX_SHEET_NAME}!{JOB_STATS_RANGE}",
+            value_render_option='UNFORMATTED_VALUE'
+        )
+        
+        # Uma célula com erro (#REF!, #N/A...) não derruba o endpoint:
+        # a contagem fica de fora e o valor vai em job_stats_errors
+        stats_errors = {}
+        for row in stats_rows:
+            if len(row) >= 2 and row[0] in stats:
+                try:
+                    stats[row[0]] = int(row[1] or 0)
+                except (TypeError, ValueError):
+                    del stats[row[0]]
+                    stats_errors[row[0]] = str(row[1])
+        
+        if stats_errors:
+            print(f"⚠ Contagens inválidas em {JOB_INDEX_SHEET_NAME}!{JOB_STATS_RANGE}: {stats_errors}")
         
-        for row in all_values[1:]:
-            if len(row) >= 3:
-                status = row[2]
-                if status in stats:
-                    stats[status] += 1
+        with _state_lock:
+            processor_running = _processor_state['is_running']
+            spreadsheet_id = _processor_state['spreadsheet_id']
         
         return jsonify({
             'success': True,
-            'processor_running': _processor_state['is_running'],
-            'spreadsheet_id': _processor_state['spreadsheet_id'],
-            'spreadsheet_name': spreadsheet.title,
+            'processor_running': processor_running,
+            'spreadsheet_id': spreadsheet_id,
+            'spreadsheet_name': ctx.spreadsheet.title,
             'job_stats': stats,
+            'job_stats_errors': stats_errors,
             'timestamp': datetime.now().isoformat()
         })
         
@@ -498,6 +1078,18 @@ def get_status():
 # INICIALIZAÇÃO DO WEBHOOK
 # ============================================================================
 
+def _create_listen_socket(port):
+    """Cria o socket do servidor permitindo reinício imediato na mesma porta"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    
+    # SO_REUSEPORT não existe em todas as plataformas
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    
+    sock.bind(('0.0.0.0', port))
+    return sock
+
 def start_webhook_server(port=5000):
     """Inicia servidor webhook com ngrok"""
     global _processor_state
@@ -509,8 +1101,15 @@ def start_webhook_server(port=5000):
     try:
         # Inicia ngrok tunnel
         print("\n1. Criando túnel ngrok...")
-        public_url = ngrok.connect(port)
-        _processor_state['webhook_url'] = public_url
+        # Domínio fixo do ngrok (opcional), lido aqui para valer o os.environ
+        # definido no notebook depois de carregar o módulo
+        ngrok_domain = os.getenv('NGROK_DOMAIN')
+        if ngrok_domain:
+            public_url = ngrok.connect(port, domain=ngrok_domain)
+        else:
+            public_url = ngrok.connect(port)
+        with _state_lock:
+            _processor_state['webhook_url'] = public_url
         
         print(f"✓ Túnel criado: {public_url}")
         print(f"\n📋 WEBHOOK URL (copie para o GAS):")
@@ -519,6 +1118,7 @@ def start_webhook_server(port=5000):
         print(f"   GET  {public_url}/health")
         print(f"   POST {public_url}/activate")
         print(f"   POST {public_url}/deactivate")
+        print(f"   POST {public_url}/wake")
         print(f"   GET  {public_url}/status")
         
         print("\n" + "=" * 60)
@@ -528,8 +1128,8 @@ def start_webhook_server(port=5000):
         print("💡 Pressione Ctrl+C para parar o servidor")
         print("\n")
         
-        # Inicia Flask
-        app.run(port=port, debug=False, use_reloader=False)
+        # Inicia Flask via waitress (WSGI multi-thread, sem reloader)
+        serve(app, sockets=[_create_listen_socket(port)], threads=8, connection_limit=64)
         
     except KeyboardInterrupt:
         print("\n\n⏹️  Servidor interrompido pelo usuário")
@@ -571,13 +1171,14 @@ def quick_start_automated(spreadsheet_id, port=5000):
 
 def get_processor_state():
     """Retorna o estado atual do processador"""
-    return {
-        'configured': _processor_state['spreadsheet'] is not None,
-        'running': _processor_state['is_running'],
-        'spreadsheet_id': _processor_state['spreadsheet_id'],
-        'spreadsheet_title': _processor_state['spreadsheet'].title if _processor_state['spreadsheet'] else None,
-        'webhook_url': _processor_state['webhook_url']
-    }
+    with _state_lock:
+        return {
+            'configured': _processor_state['spreadsheet'] is not None,
+            'running': _processor_state['is_running'],
+            'spreadsheet_id': _processor_state['spreadsheet_id'],
+            'spreadsheet_title': _processor_state['spreadsheet'].title if _processor_state['spreadsheet'] else None,
+            'webhook_url': _processor_state['webhook_url']
+        }
 
 # ============================================================================
 # HANDLER DE SINAIS
@@ -587,8 +1188,12 @@ def signal_handler(sig, frame):
     """Handler para Ctrl+C"""
     print("\n\n⏹️  Encerrando servidor...")
     stop_processor()
-    if _processor_state['webhook_url']:
-        ngrok.disconnect(_processor_state['webhook_url'])
+    
+    with _state_lock:
+        webhook_url = _processor_state['webhook_url']
+    
+    if webhook_url:
+        ngrok.disconnect(webhook_url)
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
@@ -610,6 +1215,7 @@ print("   get_processor_state()")
 print("\n🌐 ENDPOINTS DO WEBHOOK:")
 print("   POST /activate   - Ativa processador")
 print("   POST /deactivate - Desativa processador")
+print("   POST /wake       - Verifica a fila imediatamente")
 print("   GET  /status     - Status detalhado")
 print("   GET  /health     - Health check")
 print("\n" + "=" * 60)